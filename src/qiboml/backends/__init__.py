@@ -10,6 +10,20 @@ PLATFORMS = ["tensorflow", "pytorch", "jax"]
 QibomlBackend = Union[TensorflowBackend, PyTorchBackend, JaxBackend]
 
 
+def is_cpu_backend(backend) -> bool:
+    """Check whether a backend keeps its states in numpy arrays on the CPU.
+
+    Args:
+        backend (qibo.backends.abstract.Backend): the backend to check.
+    Returns:
+        bool: ``True`` for the numpy backend and for qibojit on its numba
+            platform, ``False`` otherwise, e.g. for the GPU platforms of qibojit.
+    """
+    return backend.name == "numpy" or (
+        backend.name == "qibojit" and backend.platform == "numba"
+    )
+
+
 class MetaBackend:
     """Meta-backend class which takes care of loading the qiboml backends."""
 
@@ -1,14 +1,33 @@
+from functools import lru_cache
+
 from qibo import Circuit, gates
 
 
+@lru_cache(maxsize=None)
+def _entangling_template(nqubits):
+    """Ring of CNOT gates, built only once for each number of qubits."""
+    qubits = list(range(nqubits))
+    ring = zip(qubits, qubits[1:] + qubits[:1])
+    c = Circuit(nqubits)
+    c.add(gates.CNOT(q0=q0, q1=q1) for q0, q1 in ring)
+    return c
+
+
+def entangling_layer(nqubits):
+    """
+    Entangling layer made of a ring of CNOT gates. The returned circuit is a
+    shallow copy of a cached template, thus its gates are shared among all
+    the layers built on the same number of qubits.
+    """
+    return _entangling_template(nqubits).copy()
+
+
 def reuploading_circuit(nqubits, nlayers):
     c = Circuit(nqubits)
     for _ in range(nlayers):
         for q in range(nqubits):
             c.add(gates.RY(q, 0))
             c.add(gates.RZ(q, 0))
-        for q in range(0, nqubits - 1, 1):
-            c.add(gates.CNOT(q0=q, q1=q + 1))
-        c.add(gates.CNOT(q0=nqubits - 1, q1=0))
+        c.add(_entangling_template(nqubits).queue)
     c.add(gates.M(*range(nqubits)))
     return c
@@ -1,9 +1,12 @@
 from abc import ABC, abstractmethod
 from typing import Tuple
 
-from qibo import Circuit, gates
+import numpy as np
+from qibo import Circuit
 from qibo.config import raise_error
 
+from qiboml.models.ansatze import entangling_layer
+
 
 class ReuploadingCircuit(ABC):
     def __init__(self, nqubits: int, nlayers: int, data_dimensionality: Tuple):
@@ -34,8 +37,11 @@ class ReuploadingCircuit(ABC):
         return len(self.parameters)
 
     def set_parameters(self, parameters):
-        """Set trainable parameters into the circuit."""
-        self.parameters = parameters
+        """
+        Set trainable parameters into the circuit. They are stored as a flat
+        and contiguous ``float64`` array.
+        """
+        self.parameters = np.ascontiguousarray(parameters, dtype=np.float64).ravel()
 
     @abstractmethod
     def build_circuit(self):
@@ -44,11 +50,7 @@ class ReuploadingCircuit(ABC):
 
     def build_entangling_layer(self):
         """Build circuit's entangling layer structure."""
-        c = Circuit(self.nqubits)
-        for q in range(0, self.nqubits - 1, 1):
-            c.add(gates.CNOT(q0=q, q1=q + 1))
-        c.add(gates.CNOT(q0=self.nqubits - 1, q1=0))
-        return c
+        return entangling_layer(self.nqubits)
 
     @abstractmethod
     def inject_data(self, x):
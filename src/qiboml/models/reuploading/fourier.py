@@ -47,12 +47,10 @@ class FourierReuploading(ReuploadingCircuit):
         return c
 
     def inject_data(self, x):
-        new_parameters = []
-        k = 0
-        for _ in range(self.nlayers):
-            for _ in range(self.nqubits):
-                new_parameters.append(self.parameters[k])
-                new_parameters.append(self.parameters[k + 1])
-                new_parameters.append(x)
-            k += 2
-        self.circuit.set_parameters(new_parameters)
+        # each layer uses 2 parameters, repeated on every qubit along with ``x``
+        new_parameters = np.empty((self.nlayers, self.nqubits, 3))
+        new_parameters[:, :, :2] = self.parameters[: 2 * self.nlayers].reshape(
+            self.nlayers, 1, 2
+        )
+        new_parameters[:, :, 2] = x
+        self.circuit.set_parameters(new_parameters.ravel())
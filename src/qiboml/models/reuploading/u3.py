@@ -45,18 +45,16 @@ class ReuploadingU3(ReuploadingCircuit):
         return c
 
     def inject_data(self, x):
-        new_parameters = []
-        k = 0
-        for _ in range(self.nlayers):
-            for q in range(self.nqubits):
-                new_parameters.append(
-                    self.parameters[k] * self.actf1(x[q]) + self.parameters[k + 1]
-                )
-                new_parameters.append(
-                    self.parameters[k + 2] * self.actf2(x[q]) + self.parameters[k + 3]
-                )
-                new_parameters.append(
-                    self.parameters[k + 4] * self.actf3(x[q]) + self.parameters[k + 5]
-                )
-            k += 6
-        self.circuit.set_parameters(new_parameters)
+        # activations are evaluated once per qubit and shared by all layers
+        activations = np.array(
+            [
+                [self.actf1(x[q]), self.actf2(x[q]), self.actf3(x[q])]
+                for q in range(self.nqubits)
+            ]
+        )
+        # each layer uses 6 parameters: (slope, offset) for each U3 angle
+        weights = self.parameters[: 6 * self.nlayers].reshape(self.nlayers, 3, 2)
+        new_parameters = (
+            weights[:, None, :, 0] * activations[None, :, :] + weights[:, None, :, 1]
+        )
+        self.circuit.set_parameters(new_parameters.ravel())
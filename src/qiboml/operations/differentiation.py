@@ -1,7 +1,18 @@
+from functools import lru_cache
+
 import numpy as np
+from numba import njit
+from qibo import Circuit, gates
 from qibo.backends import construct_backend
 from qibo.config import raise_error
+from qibo.hamiltonians import SymbolicHamiltonian
 from qibo.hamiltonians.abstract import AbstractHamiltonian
+from scipy import sparse
+
+from qiboml.backends import is_cpu_backend
+
+# circuits up to this size are simulated with the numba kernels defined below
+KERNEL_MAX_QUBITS = 10
 
 
 def parameter_shift(
@@ -102,8 +113,14 @@ def parameter_shift(
             "hamiltonian must be a qibo.hamiltonians.Hamiltonian or qibo.hamiltonians.SymbolicHamiltonian object",
         )
 
-    # getting the gate's type
-    gate = circuit.associate_gates_with_parameters()[parameter_index]
+    # getting the gate's type, counting only the trainable parameters as
+    # ``circuit.get_parameters()`` does
+    parameter_to_gate = [
+        (gate, index)
+        for gate in circuit.trainable_gates
+        for index in range(len(gate.parameters))
+    ]
+    gate, index = parameter_to_gate[parameter_index]
 
     # getting the generator_eigenvalue
     generator_eigenval = gate.generator_eigenvalue()
@@ -111,9 +128,28 @@ def parameter_shift(
     # defining the shift according to the psr
     s = np.pi / (4 * generator_eigenval)
 
-    # saving original parameters and making a copy
-    original = np.asarray(circuit.get_parameters()).copy()
-    shifted = original.copy()
+    # small circuits are simulated with a single compiled kernel
+    kernel_circuit = None
+    if nshots is None:
+        kernel_circuit = _kernel_circuit(
+            hamiltonian, circuit, exec_backend, initial_state
+        )
+
+    if kernel_circuit is not None:
+        forward, backward = _kernel_shift_rule(
+            kernel_circuit,
+            _kernel_hamiltonian(hamiltonian),
+            gate,
+            index,
+            s,
+            exec_backend,
+        )
+        return float(generator_eigenval * (forward - backward) * scale_factor)
+
+    # the shifted parameters are written in a buffer reused by all the calls,
+    # saving only the original value of the shifted parameter
+    shifted = _shift_buffer(circuit, np.hstack(circuit.get_parameters()))
+    original = shifted[parameter_index]
 
     # forward shift
     shifted[parameter_index] += s
@@ -150,9 +186,514 @@ def parameter_shift(
             circuit=circuit, initial_state=initial_state, nshots=nshots
         ).expectation_from_samples(hamiltonian)
 
-    circuit.set_parameters(original)
+    shifted[parameter_index] = original
+    circuit.set_parameters(shifted)
 
     # float() necessary to not return a 0-dim ndarray
     result = float(generator_eigenval * (forward - backward) * scale_factor)
 
     return result
+
+
+def parameter_shift_batch(
+    hamiltonian,
+    circuit,
+    exec_backend,
+    initial_state=None,
+    scale_factor=1,
+    nshots=None,
+):
+    """Parameter shift rule evaluated with respect to all the circuit's parameters.
+
+    Equivalent to calling :func:`parameter_shift` once for each parameter of
+    ``circuit``, but the ``2 * nparams`` shifted parameter vectors are
+    evaluated in a single sweep, shifting one entry at a time of the same
+    buffer, so that the validation and gate lookups are performed only once
+    per gradient. In simulation, when the circuit is supported by the numba
+    kernels, the same derivatives are computed by
+    :func:`adjoint_parameter_shift` instead.
+
+    Args:
+        hamiltonian (:class:`qibo.hamiltonians.Hamiltonian`): target observable.
+        circuit (:class:`qibo.models.circuit.Circuit`): custom quantum circuit.
+        exec_backend (qibo.backends.abstract.Backend): Qibo backend on which
+            the circuits are executed.
+        initial_state (ndarray, optional): initial state on which the circuit
+            acts. Default is ``None``.
+        scale_factor (float, optional): parameter scale factor. Default is ``1``.
+        nshots (int, optional): number of shots if derivatives are evaluated on
+            hardware. If ``None``, the simulation mode is executed.
+            Default is ``None``.
+
+    Returns:
+        (ndarray): Derivatives of the expectation value of the hamiltonian
+            with respect to every trainable parameter of the circuit.
+    """
+
+    if not isinstance(hamiltonian, AbstractHamiltonian):
+        raise_error(
+            TypeError,
+            "hamiltonian must be a qibo.hamiltonians.Hamiltonian or qibo.hamiltonians.SymbolicHamiltonian object",
+        )
+
+    # on simulation, all the derivatives come from a single adjoint sweep
+    kernel_circuit = None
+    if nshots is None:
+        kernel_circuit = _kernel_circuit(
+            hamiltonian, circuit, exec_backend, initial_state
+        )
+
+    if kernel_circuit is not None:
+        return _kernel_adjoint(
+            kernel_circuit, hamiltonian, circuit, exec_backend, scale_factor
+        )
+
+    # generator eigenvalue of the gate associated to each parameter
+    generator_eigenvals = np.array(
+        [
+            gate.generator_eigenvalue()
+            for gate in circuit.trainable_gates
+            for _ in gate.parameters
+        ]
+    )
+    shifts = np.pi / (4 * generator_eigenvals)
+
+    original = np.hstack(circuit.get_parameters()).astype(float)
+    nparams = len(original)
+
+    # forward and backward shifts of each parameter are written, one at a
+    # time, in a single row which is reused by the next calls on this circuit
+    shifted = _shift_buffer(circuit, original)
+    expvals = np.empty((2, nparams))
+    for p in range(nparams):
+        for k, shift in enumerate((shifts[p], -shifts[p])):
+            shifted[p] = original[p] + shift
+            circuit.set_parameters(shifted)
+            if nshots is None:
+                expvals[k, p] = hamiltonian.expectation(
+                    exec_backend.execute_circuit(
+                        circuit=circuit, initial_state=initial_state
+                    ).state()
+                )
+            else:
+                expvals[k, p] = exec_backend.execute_circuit(
+                    circuit=circuit, initial_state=initial_state, nshots=nshots
+                ).expectation_from_samples(hamiltonian)
+        shifted[p] = original[p]
+
+    circuit.set_parameters(original)
+
+    forward, backward = expvals
+
+    return generator_eigenvals * (forward - backward) * scale_factor
+
+
+def adjoint_parameter_shift(
+    hamiltonian,
+    circuit,
+    exec_backend,
+    initial_state=None,
+    scale_factor=1,
+    nshots=None,
+):
+    """Derivatives with respect to all the circuit's parameters with a single
+    adjoint sweep.
+
+    The circuit is executed once, then the final state and the hamiltonian
+    applied to it are propagated backwards gate by gate. When a parametrized
+    gate :math:`U(\\theta)` is met, its derivative is obtained from the operator
+    form of the shift rule,
+    :math:`\\partial_\\theta U = \\frac{r}{2}\\left[U(\\theta + \\frac{\\pi}{2r}) - U(\\theta - \\frac{\\pi}{2r})\\right]`,
+    where :math:`r` is the generator eigenvalue, applied locally to the
+    propagated states. This replaces the ``2 * nparams`` circuit executions
+    of the parameter shift rule with one forward and one backward sweep, and
+    returns the same derivatives of :func:`parameter_shift_batch`.
+
+    Since it needs access to the state, it is only available in simulation,
+    for the circuits supported by the numba kernels of this module. On
+    hardware, use :func:`parameter_shift` instead.
+
+    Args:
+        hamiltonian (:class:`qibo.hamiltonians.Hamiltonian`): target observable.
+        circuit (:class:`qibo.models.circuit.Circuit`): custom quantum circuit.
+        exec_backend (qibo.backends.abstract.Backend): Qibo backend on which
+            the circuits are executed.
+        initial_state (ndarray, optional): initial state on which the circuit
+            acts. Default is ``None``.
+        scale_factor (float, optional): parameter scale factor. Default is ``1``.
+        nshots (int, optional): must be ``None``, the adjoint method does not
+            support shots. Default is ``None``.
+
+    Returns:
+        (ndarray): Derivatives of the expectation value of the hamiltonian
+            with respect to every trainable parameter of the circuit.
+    """
+
+    if not isinstance(hamiltonian, AbstractHamiltonian):
+        raise_error(
+            TypeError,
+            "hamiltonian must be a qibo.hamiltonians.Hamiltonian or qibo.hamiltonians.SymbolicHamiltonian object",
+        )
+
+    if nshots is not None:
+        raise_error(
+            ValueError,
+            "The adjoint method cannot be evaluated from samples, use the parameter shift rule instead.",
+        )
+
+    kernel_circuit = _kernel_circuit(hamiltonian, circuit, exec_backend, initial_state)
+    if kernel_circuit is None:
+        raise_error(
+            NotImplementedError,
+            "The adjoint method is not available for this circuit and execution backend.",
+        )
+
+    return _kernel_adjoint(
+        kernel_circuit, hamiltonian, circuit, exec_backend, scale_factor
+    )
+
+
+def _shift_buffer(circuit, parameters):
+    """
+    Flat buffer holding a copy of ``parameters``, the parameters of
+    ``circuit``, where the shift rules write the shifted values. It is
+    allocated once and stored on ``circuit``.
+    """
+    buffer = getattr(circuit, "_psr_buffer", None)
+    if buffer is None or buffer.shape != parameters.shape:
+        buffer = circuit._psr_buffer = np.empty(parameters.shape)
+    np.copyto(buffer, parameters)
+    return buffer
+
+
+def _kernel_circuit(hamiltonian, circuit, exec_backend, initial_state=None):
+    """
+    Collect the gates of ``circuit`` in the arrays consumed by the numba
+    kernels. Returns ``None`` if the circuit cannot be simulated by them,
+    which happens for density matrices, noise, collapsing measurements,
+    special gates such as callbacks and fused gates, gates acting on more
+    than two qubits and non-numpy execution backends. Since the kernels do
+    not check the sizes of their inputs, ``hamiltonian`` and
+    ``initial_state`` are validated against ``circuit`` here.
+    """
+    if (
+        not is_cpu_backend(exec_backend)
+        or circuit.nqubits > KERNEL_MAX_QUBITS
+        or circuit.density_matrix
+        or circuit.accelerators
+        or circuit.repeated_execution
+        or isinstance(initial_state, Circuit)
+    ):
+        return None
+
+    queue = [gate for gate in circuit.queue if not isinstance(gate, gates.M)]
+    if any(
+        isinstance(gate, (gates.Channel, gates.SpecialGate))
+        or gate.is_controlled_by
+        or len(gate.qubits) > 2
+        or not hasattr(exec_backend.matrices, gate.__class__.__name__)
+        for gate in queue
+    ):
+        return None
+
+    if hamiltonian.nqubits != circuit.nqubits:
+        raise_error(
+            ValueError,
+            f"Hamiltonian acts on {hamiltonian.nqubits} qubits, but the circuit has {circuit.nqubits}.",
+        )
+
+    signature = tuple(
+        (
+            gate.__class__.__name__,
+            gate.qubits,
+            isinstance(gate, gates.ParametrizedGate),
+        )
+        for gate in queue
+    )
+    template, targets, ntargets, parametrized = _kernel_layout(signature)
+    matrices = template.copy()
+    for i in parametrized:
+        n = ntargets[i]
+        matrices[i, : 2**n, : 2**n] = exec_backend.to_numpy(
+            queue[i].matrix(exec_backend)
+        )
+
+    if initial_state is None:
+        state = np.zeros(2**circuit.nqubits, dtype=np.complex128)
+        state[0] = 1
+    else:
+        state = np.array(exec_backend.to_numpy(initial_state), dtype=np.complex128)
+        if state.shape != (2**circuit.nqubits,):
+            raise_error(
+                ValueError,
+                f"Initial state of shape {state.shape} cannot be used with a circuit of {circuit.nqubits} qubits.",
+            )
+
+    return queue, matrices, targets, ntargets, state
+
+
+@lru_cache(maxsize=32)
+def _kernel_layout(signature):
+    """
+    Arrays describing the structure of a circuit, built only once for each
+    ``signature`` listing the name, the qubits and whether each gate is
+    parametrized. Returns the matrices of the non-parametrized gates, the
+    target qubits of every gate and the positions of the parametrized gates,
+    whose matrices are the only ones to be filled at every call.
+    """
+    backend = construct_backend("numpy")
+    matrices = np.zeros((len(signature), 4, 4), dtype=np.complex128)
+    targets = np.zeros((len(signature), 2), dtype=np.int64)
+    ntargets = np.zeros(len(signature), dtype=np.int64)
+    parametrized = []
+    for i, (name, qubits, is_parametrized) in enumerate(signature):
+        n = len(qubits)
+        targets[i, :n] = qubits
+        ntargets[i] = n
+        if is_parametrized:
+            parametrized.append(i)
+            continue
+        matrix = getattr(backend.matrices, name)
+        if callable(matrix):
+            matrix = matrix(2**n)
+        matrices[i, : 2**n, : 2**n] = matrix
+
+    # shared by all the circuits with the same signature
+    for array in (matrices, targets, ntargets):
+        array.flags.writeable = False
+    return matrices, targets, ntargets, tuple(parametrized)
+
+
+def _kernel_hamiltonian(hamiltonian):
+    """
+    CSR ``(data, indices, indptr)`` arrays of the matrix of ``hamiltonian``
+    for the numba kernels. Symbolic Hamiltonians are assembled term by term
+    with :func:`_symbolic_csr`, without building their dense matrix. The
+    arrays are stored on ``hamiltonian`` and rebuilt only when its matrix,
+    or its terms and constant for symbolic Hamiltonians, are replaced.
+    """
+    if isinstance(hamiltonian, SymbolicHamiltonian):
+        source, constant = hamiltonian.terms, hamiltonian.constant
+    else:
+        source, constant = hamiltonian.matrix, None
+
+    cached = getattr(hamiltonian, "_kernel_csr", None)
+    if cached is None or cached[0] is not source or cached[1] != constant:
+        if isinstance(hamiltonian, SymbolicHamiltonian):
+            csr = _symbolic_csr(hamiltonian)
+        elif hamiltonian.backend.issparse(source):
+            csr = sparse.csr_matrix(source, dtype=np.complex128)
+        else:
+            csr = sparse.csr_matrix(
+                hamiltonian.backend.to_numpy(source), dtype=np.complex128
+            )
+        arrays = (
+            csr.data,
+            csr.indices.astype(np.int64),
+            csr.indptr.astype(np.int64),
+        )
+        cached = (source, constant, arrays)
+        hamiltonian._kernel_csr = cached
+    return cached[2]
+
+
+def _symbolic_csr(hamiltonian):
+    """
+    CSR matrix of a symbolic ``hamiltonian``, obtained by embedding the
+    matrix of each term, which only acts on its target qubits, in the full
+    space. Only the non-zero entries of the terms are ever computed.
+    """
+    nqubits = hamiltonian.nqubits
+    size = 2**nqubits
+    basis = np.arange(size)
+
+    # the constant is added on the diagonal
+    rows, cols = [basis], [basis]
+    data = [np.full(size, hamiltonian.constant, dtype=np.complex128)]
+    for term in hamiltonian.terms:
+        matrix = hamiltonian.backend.to_numpy(term.matrix)
+        # position of the bit of each target qubit, qubit 0 being the most significant
+        shifts = [nqubits - 1 - q for q in term.target_qubits]
+        ntargets = len(shifts)
+        local = np.zeros(size, dtype=np.int64)
+        others = basis.copy()
+        for m, shift in enumerate(shifts):
+            local |= ((basis >> shift) & 1) << (ntargets - 1 - m)
+            others &= ~(1 << shift)
+        for row, col in zip(*np.nonzero(matrix)):
+            selected = local == row
+            spread = sum(
+                ((col >> (ntargets - 1 - m)) & 1) << shift
+                for m, shift in enumerate(shifts)
+            )
+            rows.append(basis[selected])
+            cols.append(others[selected] | spread)
+            data.append(np.full(len(rows[-1]), matrix[row, col]))
+
+    return sparse.csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(size, size),
+        dtype=np.complex128,
+    )
+
+
+def _shifted_matrices(gate, index, shifts, exec_backend):
+    """
+    Matrices of ``gate``, padded to ``4 x 4``, with its ``index``-th
+    parameter shifted by each value in ``shifts``.
+    """
+    n = len(gate.qubits)
+    shifted = np.zeros((len(shifts), 4, 4), dtype=np.complex128)
+    for k, shift in enumerate(shifts):
+        parameters = [float(x) for x in gate.parameters]
+        parameters[index] += shift
+        shifted[k, : 2**n, : 2**n] = exec_backend.to_numpy(
+            getattr(exec_backend.matrices, gate.__class__.__name__)(*parameters)
+        )
+    return shifted
+
+
+def _kernel_shift_rule(kernel_circuit, matrix, gate, index, shift, exec_backend):
+    """
+    Expectation values of ``matrix`` after shifting by ``+shift`` and
+    ``-shift`` the ``index``-th parameter of ``gate``, evaluated with
+    :func:`_psr_kernel` on the arrays built by :func:`_kernel_circuit`.
+    """
+    queue, matrices, targets, ntargets, state = kernel_circuit
+    return _psr_kernel(
+        state,
+        matrices,
+        targets,
+        ntargets,
+        queue.index(gate),
+        _shifted_matrices(gate, index, (shift, -shift), exec_backend),
+        matrix,
+    )
+
+
+def _kernel_adjoint(kernel_circuit, hamiltonian, circuit, exec_backend, scale_factor):
+    """
+    Derivatives with respect to all the trainable parameters of ``circuit``,
+    evaluated with :func:`_adjoint_kernel` on the arrays built by
+    :func:`_kernel_circuit`.
+    """
+    queue, matrices, targets, ntargets, state = kernel_circuit
+
+    positions, derivatives = [], []
+    for gate in circuit.trainable_gates:
+        # operator shift rule, twice the shift of the expectation values
+        eigenval = gate.generator_eigenvalue()
+        shift = np.pi / (2 * eigenval)
+        for index in range(len(gate.parameters)):
+            plus, minus = _shifted_matrices(gate, index, (shift, -shift), exec_backend)
+            positions.append(queue.index(gate))
+            derivatives.append(eigenval / 2 * (plus - minus))
+
+    daggers = np.ascontiguousarray(np.conj(np.transpose(matrices, (0, 2, 1))))
+    gradients = _adjoint_kernel(
+        state,
+        matrices,
+        daggers,
+        targets,
+        ntargets,
+        np.array(positions, dtype=np.int64),
+        np.array(derivatives, dtype=np.complex128).reshape(-1, 4, 4),
+        _kernel_hamiltonian(hamiltonian),
+    )
+    return gradients * scale_factor
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _apply_matrix(state, matrix, targets, ntargets, nqubits):
+    """Apply in place a one or two qubits ``matrix`` on ``targets``."""
+    m0 = 1 << (nqubits - 1 - targets[0])
+    if ntargets == 1:
+        for i in range(state.shape[0]):
+            if i & m0:
+                continue
+            s0, s1 = state[i], state[i | m0]
+            state[i] = matrix[0, 0] * s0 + matrix[0, 1] * s1
+            state[i | m0] = matrix[1, 0] * s0 + matrix[1, 1] * s1
+    else:
+        m1 = 1 << (nqubits - 1 - targets[1])
+        mask = m0 | m1
+        for i in range(state.shape[0]):
+            if i & mask:
+                continue
+            s0, s1, s2, s3 = state[i], state[i | m1], state[i | m0], state[i | mask]
+            for row, j in enumerate((i, i | m1, i | m0, i | mask)):
+                state[j] = (
+                    matrix[row, 0] * s0
+                    + matrix[row, 1] * s1
+                    + matrix[row, 2] * s2
+                    + matrix[row, 3] * s3
+                )
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _csr_dot(hamiltonian, state, out):
+    """
+    Product of the ``(data, indices, indptr)`` CSR ``hamiltonian`` and
+    ``state``, written in ``out``.
+    """
+    data, indices, indptr = hamiltonian
+    for i in range(state.shape[0]):
+        value = 0j
+        for k in range(indptr[i], indptr[i + 1]):
+            value += data[k] * state[indices[k]]
+        out[i] = value
+    return out
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _psr_kernel(state, matrices, targets, ntargets, position, shifted, hamiltonian):
+    """
+    Execute the circuit twice starting from ``state``, replacing the gate in
+    ``position`` with ``shifted[0]`` and ``shifted[1]`` respectively, and
+    return the two expectation values of ``hamiltonian``.
+    """
+    nqubits = int(np.log2(state.shape[0]))
+    expvals = np.empty(2)
+    # the same work buffers are reused by both executions
+    psi = np.empty_like(state)
+    hpsi = np.empty_like(state)
+    for k in range(2):
+        psi[:] = state
+        for g in range(matrices.shape[0]):
+            if g == position:
+                _apply_matrix(psi, shifted[k], targets[g], ntargets[g], nqubits)
+            else:
+                _apply_matrix(psi, matrices[g], targets[g], ntargets[g], nqubits)
+        expvals[k] = np.real(np.vdot(psi, _csr_dot(hamiltonian, psi, hpsi)))
+    return expvals[0], expvals[1]
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _adjoint_kernel(
+    state, matrices, daggers, targets, ntargets, positions, derivatives, hamiltonian
+):
+    """
+    Execute the circuit on ``state``, then propagate backwards both the final
+    state and ``hamiltonian`` applied to it, collecting the derivative of the
+    expectation value for each of the ``derivatives`` matrices of the gates in
+    ``positions``, which are sorted in circuit order.
+    """
+    nqubits = int(np.log2(state.shape[0]))
+    psi = state.copy()
+    for g in range(matrices.shape[0]):
+        _apply_matrix(psi, matrices[g], targets[g], ntargets[g], nqubits)
+    phi = _csr_dot(hamiltonian, psi, np.empty_like(psi))
+    dpsi = np.empty_like(psi)
+
+    gradients = np.zeros(positions.shape[0])
+    p = positions.shape[0] - 1
+    for g in range(matrices.shape[0] - 1, -1, -1):
+        # state right before gate ``g``
+        _apply_matrix(psi, daggers[g], targets[g], ntargets[g], nqubits)
+        while p >= 0 and positions[p] == g:
+            dpsi[:] = psi
+            _apply_matrix(dpsi, derivatives[p], targets[g], ntargets[g], nqubits)
+            gradients[p] = 2 * np.real(np.vdot(phi, dpsi))
+            p -= 1
+        _apply_matrix(phi, daggers[g], targets[g], ntargets[g], nqubits)
+    return gradients
@@ -1,12 +1,32 @@
 """Compute expectation values of target observables with the freedom of setting any qibo's backend."""
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import List, Optional, Union
 
+import numpy as np
 import qibo
 from qibo.backends import construct_backend
 from qibo.config import raise_error
+from qibo.hamiltonians import Hamiltonian, SymbolicHamiltonian
+from scipy import sparse
 
-from qiboml.backends import TensorflowBackend
+from qiboml.backends import TensorflowBackend, is_cpu_backend
+from qiboml.operations.differentiation import (
+    adjoint_parameter_shift,
+    parameter_shift,
+    parameter_shift_batch,
+)
+
+# dense observables with a smaller fraction of non-zero entries are made sparse
+SPARSE_DENSITY = 0.01
+
+# differentiation rules which can compute all the derivatives in a single call
+BATCHED_RULES = {
+    parameter_shift: parameter_shift_batch,
+    adjoint_parameter_shift: adjoint_parameter_shift,
+}
 
 
 def expectation(
@@ -16,6 +36,9 @@ def expectation(
     nshots: int = None,
     backend: str = "qibojit",
     differentiation_rule: Optional[callable] = None,
+    cache: Optional[bool] = None,
+    precision: str = "double",
+    parallel: bool = False,
 ):
     """
     Compute the expectation value of ``observable`` over the state obtained by
@@ -44,36 +67,121 @@ def expectation(
         differentiation_rule (Optional[callable]): the chosen differentiation
             rule. It can be selected among the methods implemented in
             ``qiboml.differentiation``.
+        cache (Optional[bool]): if ``True``, the execution backend and the
+            observable cast to it are built once and reused by the following
+            calls, which is convenient when the forward and the backward
+            passes evaluate the same observable many times. Dense
+            Hamiltonians with few non-zero entries are converted to CSR
+            format only by this cache: without it, ``observable`` is
+            evaluated as it is, with its matrix on the frontend backend.
+            If ``None``, it is enabled only when a ``differentiation_rule``
+            is set.
+        precision (str): precision of the simulation, either ``"double"`` or
+            ``"single"``. In single precision the circuit is executed with
+            ``complex64`` states and the observable cast to the execution
+            backend is stored as ``complex64``, halving the memory traffic.
+            Derivatives computed by the simulation kernels of
+            ``qiboml.differentiation`` are always evaluated in double precision.
+        parallel (bool): if ``True``, differentiation rules evaluated one
+            parameter at a time are run concurrently over chunks of the
+            parameters, each one on its own copy of ``circuit``. The numba
+            kernels of ``qiboml.differentiation`` release the GIL, so
+            small circuits are simulated concurrently by the threads. Rules
+            computing all the derivatives in a single call, such as the
+            batched parameter shift and the adjoint rules, are not affected.
     """
 
+    if cache is None:
+        cache = differentiation_rule is not None
+
     # read the frontend user choice
     frontend = observable.backend
-    exec_backend = construct_backend(backend)
-
-    kwargs = dict(
-        observable=observable,
-        circuit=circuit,
-        initial_state=initial_state,
-        nshots=nshots,
-        differentiation_rule=differentiation_rule,
-        exec_backend=exec_backend,
-    )
 
-    if differentiation_rule is not None:
-        if isinstance(frontend, TensorflowBackend):
-            return _with_tf(**kwargs)
-
-    elif nshots is None:
-        return _exact(observable, circuit, initial_state, exec_backend)
+    if cache:
+        exec_backend = _cached_backend(backend, precision)
+        if nshots is None:
+            observable = _prepare_observable(observable, exec_backend)
     else:
+        exec_backend = construct_backend(backend)
+        exec_backend.set_precision(precision)
+
+    if differentiation_rule is None:
+        if nshots is None:
+            return _exact(observable, circuit, initial_state, exec_backend)
         return _with_shots(observable, circuit, initial_state, nshots, exec_backend)
 
+    if isinstance(frontend, TensorflowBackend):
+        return _with_tf(
+            observable=observable,
+            circuit=circuit,
+            initial_state=initial_state,
+            nshots=nshots,
+            differentiation_rule=differentiation_rule,
+            exec_backend=exec_backend,
+            parallel=parallel,
+        )
+
     raise_error(
         NotImplementedError,
         "Only tensorflow automatic differentiation is supported at this moment.",
     )
 
 
+@lru_cache(maxsize=None)
+def _cached_backend(backend, precision):
+    """Helper function constructing each execution backend only once per precision."""
+    exec_backend = construct_backend(backend)
+    exec_backend.set_precision(precision)
+    return exec_backend
+
+
+def _prepare_observable(observable, exec_backend):
+    """
+    Helper function moving ``observable`` to ``exec_backend``, so that exact
+    expectation values are computed without moving the states back to the
+    frontend. Symbolic Hamiltonians share their terms with the original one,
+    and keep being evaluated term by term without building the dense matrix. Dense
+    Hamiltonians are stored in CSR format when the execution backend
+    supports ``scipy.sparse`` and less than ``SPARSE_DENSITY`` of the
+    entries are non-zero. Results are stored on ``observable`` for each
+    execution backend, and rebuilt when its matrix, or its terms and constant
+    for symbolic Hamiltonians, are replaced.
+    """
+    if isinstance(observable, SymbolicHamiltonian):
+        source, constant = observable.terms, observable.constant
+    else:
+        source, constant = observable.matrix, None
+
+    prepared = getattr(observable, "_prepared", None)
+    if prepared is None:
+        prepared = observable._prepared = {}
+    cached = prepared.get(exec_backend)
+    if cached is None or cached[0] is not source or cached[1] != constant:
+        cached = (source, constant, _move_observable(observable, exec_backend))
+        prepared[exec_backend] = cached
+    return cached[2]
+
+
+def _move_observable(observable, exec_backend):
+    """Helper function building the copy of ``observable`` on ``exec_backend``."""
+    if isinstance(observable, SymbolicHamiltonian):
+        moved = SymbolicHamiltonian(backend=exec_backend)
+        moved.terms = observable.terms
+        moved.constant = observable.constant
+        moved.nqubits = observable.nqubits
+        return moved
+
+    matrix = observable.backend.to_numpy(observable.matrix)
+    if (
+        is_cpu_backend(exec_backend)
+        and np.count_nonzero(matrix) < SPARSE_DENSITY * matrix.size
+    ):
+        matrix = sparse.csr_matrix(matrix)
+    return Hamiltonian(
+        observable.nqubits, exec_backend.cast(matrix), backend=exec_backend
+    )
+
+
 def _exact(observable, circuit, initial_state, exec_backend):
     """Helper function to compute exact expectation values."""
     return observable.expectation(
@@ -90,6 +198,60 @@ def _with_shots(observable, circuit, initial_state, nshots, exec_backend):
     ).expectation_from_samples(observable)
 
 
+def _gradient(
+    observable,
+    circuit,
+    initial_state,
+    nshots,
+    exec_backend,
+    differentiation_rule,
+    nparams,
+    parallel=False,
+):
+    """
+    Helper function to compute the derivatives of the expectation value with
+    respect to all the circuit's parameters, using the batched version of
+    ``differentiation_rule`` when available. Otherwise, the derivatives are
+    evaluated one by one, concurrently over chunks of parameters if
+    ``parallel`` is ``True``. The workers share ``exec_backend``, which is
+    safe since the numpy and qibojit backends keep the simulated states
+    local to each execution, and only the circuit, whose parameters are
+    shifted in place, is copied for each chunk.
+    """
+    kwargs = dict(
+        circuit=circuit,
+        hamiltonian=observable,
+        initial_state=initial_state,
+        nshots=nshots,
+        exec_backend=exec_backend,
+    )
+
+    batched_rule = BATCHED_RULES.get(differentiation_rule)
+    if batched_rule is not None:
+        return batched_rule(**kwargs)
+
+    if not parallel or nparams < 2:
+        return np.array(
+            [differentiation_rule(parameter_index=p, **kwargs) for p in range(nparams)]
+        )
+
+    nworkers = min(os.cpu_count() or 1, nparams)
+    chunksize = -(-nparams // nworkers)
+
+    def _chunk(indices):
+        # the rules shift the parameters in place, thus each worker needs its own circuit
+        chunk_kwargs = dict(kwargs, circuit=circuit.copy(deep=True))
+        return [
+            differentiation_rule(parameter_index=p, **chunk_kwargs) for p in indices
+        ]
+
+    chunks = [
+        range(i, min(i + chunksize, nparams)) for i in range(0, nparams, chunksize)
+    ]
+    with ThreadPoolExecutor(max_workers=nworkers) as executor:
+        return np.concatenate(list(executor.map(_chunk, chunks)))
+
+
 def _with_tf(
     observable,
     circuit,
@@ -97,6 +259,7 @@ def _with_tf(
     nshots,
     exec_backend,
     differentiation_rule,
+    parallel,
 ):
     """
     Compute expectation sample integrating the custom differentiation rule with
@@ -109,23 +272,18 @@ def _with_tf(
 
     @tf.custom_gradient
     def _expectation(params):
-        params = tf.Variable(params)
-
         def grad(upstream):
-            gradients = []
-            for p in range(nparams):
-                gradients.append(
-                    upstream
-                    * differentiation_rule(
-                        circuit=circuit,
-                        hamiltonian=observable,
-                        parameter_index=p,
-                        initial_state=initial_state,
-                        nshots=nshots,
-                        exec_backend=exec_backend,
-                    )
-                )
-            return gradients
+            gradients = _gradient(
+                observable,
+                circuit,
+                initial_state,
+                nshots,
+                exec_backend,
+                differentiation_rule,
+                nparams,
+                parallel,
+            )
+            return tf.unstack(upstream * gradients)
 
         if nshots is None:
             expval = _exact(observable, circuit, initial_state, exec_backend)
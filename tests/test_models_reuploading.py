@@ -1,3 +1,8 @@
+from math import exp, log
+
+import numpy as np
+
+from qiboml.models.ansatze import entangling_layer
 from qiboml.models.reuploading.fourier import FourierReuploading
 from qiboml.models.reuploading.u3 import ReuploadingU3
 
@@ -12,3 +17,53 @@ def test_reuloading_u3():
     model.inject_data((0.4, 0.5, 0.6))
     new_angles = model.circuit.get_parameters()
     assert init_angles != new_angles
+
+
+def test_inject_data_u3():
+    model = ReuploadingU3(nqubits=NQUBITS, nlayers=NLAYERS, data_dimensionality=DATADIM)
+    x = (0.4, 0.5, 0.6)
+    model.inject_data(x)
+
+    p = model.parameters
+    target = []
+    for layer in range(NLAYERS):
+        k = 6 * layer
+        for q in range(NQUBITS):
+            target.append(p[k] * x[q] + p[k + 1])
+            target.append(p[k + 2] * log(x[q]) + p[k + 3])
+            target.append(p[k + 4] * exp(x[q]) + p[k + 5])
+    np.testing.assert_allclose(
+        model.circuit.get_parameters(format="flatlist"), target, rtol=1e-14
+    )
+
+
+def test_inject_data_fourier():
+    model = FourierReuploading(
+        nqubits=NQUBITS, nlayers=NLAYERS, data_dimensionality=(1,)
+    )
+    x = 0.7
+    model.inject_data(x)
+
+    p = model.parameters
+    target = []
+    for layer in range(NLAYERS):
+        k = 2 * layer
+        for _ in range(NQUBITS):
+            target.extend((p[k], p[k + 1], x))
+    np.testing.assert_allclose(
+        model.circuit.get_parameters(format="flatlist"), target, rtol=1e-14
+    )
+
+
+def test_entangling_layer():
+    layer = entangling_layer(NQUBITS)
+    pairs = [gate.qubits for gate in layer.queue]
+    assert pairs == [(0, 1), (1, 2), (2, 0)]
+
+
+def test_set_parameters():
+    model = ReuploadingU3(nqubits=NQUBITS, nlayers=NLAYERS, data_dimensionality=DATADIM)
+    model.set_parameters([[0.1, 0.2], [0.3, 0.4]])
+    assert model.parameters.dtype == np.float64
+    assert model.parameters.flags.c_contiguous
+    assert model.nparams == 4
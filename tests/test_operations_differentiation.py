@@ -0,0 +1,317 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from qibo import Circuit, callbacks, gates, hamiltonians
+from qibo.backends import construct_backend
+from qibo.symbols import X, Y, Z
+from scipy import sparse
+
+from qiboml.backends import is_cpu_backend
+from qiboml.models.ansatze import reuploading_circuit
+from qiboml.operations import differentiation
+from qiboml.operations.differentiation import (
+    adjoint_parameter_shift,
+    parameter_shift,
+    parameter_shift_batch,
+)
+
+NQUBITS = 3
+NLAYERS = 2
+
+
+def test_parameter_shift_batch():
+    exec_backend = construct_backend("numpy")
+    hamiltonian = hamiltonians.Z(NQUBITS, backend=exec_backend)
+    circuit = reuploading_circuit(nqubits=NQUBITS, nlayers=NLAYERS)
+    nparams = len(circuit.get_parameters())
+    parameters = np.random.randn(nparams)
+    circuit.set_parameters(parameters)
+
+    gradients = parameter_shift_batch(
+        hamiltonian=hamiltonian, circuit=circuit, exec_backend=exec_backend
+    )
+    target = [
+        parameter_shift(
+            hamiltonian=hamiltonian,
+            circuit=circuit,
+            parameter_index=p,
+            exec_backend=exec_backend,
+        )
+        for p in range(nparams)
+    ]
+    np.testing.assert_allclose(gradients, target, atol=1e-10)
+    np.testing.assert_allclose(np.hstack(circuit.get_parameters()), parameters)
+
+
+def test_parameter_shift_kernel(monkeypatch):
+    exec_backend = construct_backend("numpy")
+    hamiltonian = hamiltonians.Z(NQUBITS, backend=exec_backend)
+    circuit = reuploading_circuit(nqubits=NQUBITS, nlayers=NLAYERS)
+    circuit.set_parameters(np.random.randn(len(circuit.get_parameters())))
+
+    gradients = parameter_shift_batch(
+        hamiltonian=hamiltonian, circuit=circuit, exec_backend=exec_backend
+    )
+    # disable the numba kernels to fall back to the backend execution
+    monkeypatch.setattr(differentiation, "KERNEL_MAX_QUBITS", 0)
+    for _ in range(2):
+        target = parameter_shift_batch(
+            hamiltonian=hamiltonian, circuit=circuit, exec_backend=exec_backend
+        )
+        np.testing.assert_allclose(gradients, target, atol=1e-10)
+    # a single row of shifted parameters is kept on the circuit
+    assert circuit._psr_buffer.shape == gradients.shape
+
+
+def test_parameter_shift_non_trainable(monkeypatch):
+    exec_backend = construct_backend("numpy")
+    hamiltonian = hamiltonians.TFIM(4, h=0.5, backend=exec_backend)
+    circuit = Circuit(4)
+    for _ in range(NLAYERS):
+        for q in range(4):
+            circuit.add(gates.RY(q, theta=np.random.randn(), trainable=False))
+            circuit.add(gates.RX(q, theta=np.random.randn()))
+        circuit.add(gates.CNOT(q, (q + 1) % 4) for q in range(4))
+    nparams = len(circuit.get_parameters())
+
+    def gradients():
+        return [
+            parameter_shift(
+                hamiltonian=hamiltonian,
+                circuit=circuit,
+                parameter_index=p,
+                exec_backend=exec_backend,
+            )
+            for p in range(nparams)
+        ]
+
+    kernel = gradients()
+    # disable the numba kernels to fall back to the backend execution
+    monkeypatch.setattr(differentiation, "KERNEL_MAX_QUBITS", 0)
+    np.testing.assert_allclose(kernel, gradients(), atol=1e-10)
+
+
+@pytest.mark.parametrize("special", ["callback", "fused"])
+def test_parameter_shift_special_gates(special):
+    exec_backend = construct_backend("numpy")
+    hamiltonian = hamiltonians.TFIM(NQUBITS, h=0.5, backend=exec_backend)
+    circuit = reuploading_circuit(nqubits=NQUBITS, nlayers=NLAYERS)
+    nparams = len(circuit.get_parameters())
+    circuit.set_parameters(np.random.randn(nparams))
+    target = parameter_shift_batch(
+        hamiltonian=hamiltonian, circuit=circuit, exec_backend=exec_backend
+    )
+
+    if special == "callback":
+        circuit.add(gates.CallbackGate(callbacks.EntanglementEntropy([0])))
+    else:
+        circuit = circuit.fuse()
+
+    # these circuits are not supported by the kernels and use the backend
+    gradients = [
+        parameter_shift(
+            hamiltonian=hamiltonian,
+            circuit=circuit,
+            parameter_index=p,
+            exec_backend=exec_backend,
+        )
+        for p in range(nparams)
+    ]
+    np.testing.assert_allclose(gradients, target, atol=1e-10)
+
+
+@pytest.mark.parametrize("mismatch", ["hamiltonian", "initial_state"])
+@pytest.mark.parametrize(
+    "rule", [parameter_shift, parameter_shift_batch, adjoint_parameter_shift]
+)
+def test_kernel_sizes(rule, mismatch):
+    exec_backend = construct_backend("numpy")
+    circuit = reuploading_circuit(nqubits=NQUBITS, nlayers=NLAYERS)
+    if mismatch == "hamiltonian":
+        hamiltonian = hamiltonians.Z(NQUBITS - 1, backend=exec_backend)
+        initial_state = None
+    else:
+        hamiltonian = hamiltonians.Z(NQUBITS, backend=exec_backend)
+        initial_state = np.ones(2 ** (NQUBITS - 1)) / np.sqrt(2 ** (NQUBITS - 1))
+    kwargs = {"parameter_index": 0} if rule is parameter_shift else {}
+
+    with pytest.raises(ValueError):
+        rule(
+            hamiltonian=hamiltonian,
+            circuit=circuit,
+            exec_backend=exec_backend,
+            initial_state=initial_state,
+            **kwargs,
+        )
+
+
+@pytest.mark.parametrize(
+    "name,platform,expected",
+    [
+        ("numpy", None, True),
+        ("qibojit", "numba", True),
+        ("qibojit", "cupy", False),
+        ("qibojit", "cuquantum", False),
+        ("tensorflow", None, False),
+    ],
+)
+def test_is_cpu_backend(name, platform, expected):
+    exec_backend = SimpleNamespace(name=name, platform=platform)
+    assert is_cpu_backend(exec_backend) is expected
+
+
+@pytest.mark.parametrize("nshots", [None, 1000])
+def test_parameter_shift_buffer(monkeypatch, nshots):
+    exec_backend = construct_backend("numpy")
+    hamiltonian = hamiltonians.Z(NQUBITS, backend=exec_backend)
+    circuit = reuploading_circuit(nqubits=NQUBITS, nlayers=NLAYERS)
+    nparams = len(circuit.get_parameters())
+    circuit.set_parameters(np.random.randn(nparams))
+    parameters = circuit.get_parameters()
+    # disable the numba kernels to fall back to the backend execution
+    monkeypatch.setattr(differentiation, "KERNEL_MAX_QUBITS", 0)
+
+    def evaluate(shifted):
+        circuit.set_parameters(shifted)
+        if nshots is None:
+            return hamiltonian.expectation(
+                exec_backend.execute_circuit(circuit).state()
+            )
+        return exec_backend.execute_circuit(
+            circuit, nshots=nshots
+        ).expectation_from_samples(hamiltonian)
+
+    for p in range(nparams):
+        exec_backend.set_seed(p)
+        gradient = parameter_shift(
+            hamiltonian=hamiltonian,
+            circuit=circuit,
+            parameter_index=p,
+            exec_backend=exec_backend,
+            nshots=nshots,
+        )
+        assert circuit.get_parameters() == parameters
+
+        # copy-based evaluation, with the same samples in the same order
+        exec_backend.set_seed(p)
+        shift = np.pi / 2
+        forward, backward = np.hstack(parameters), np.hstack(parameters)
+        forward[p] += shift
+        backward[p] -= shift
+        target = 0.5 * (evaluate(forward) - evaluate(backward))
+        circuit.set_parameters(parameters)
+        np.testing.assert_allclose(gradient, target, atol=1e-10)
+
+
+def layout_circuit(pairs):
+    circuit = Circuit(NQUBITS)
+    for q in range(NQUBITS):
+        circuit.add(gates.RY(q, theta=np.random.randn(), trainable=False))
+        circuit.add(gates.RX(q, theta=np.random.randn()))
+    circuit.add(gates.H(0))
+    circuit.add(gates.CNOT(q0, q1) for q0, q1 in pairs)
+    circuit.add(gates.RZ(NQUBITS - 1, theta=np.random.randn()))
+    return circuit
+
+
+def test_kernel_layout(monkeypatch):
+    exec_backend = construct_backend("numpy")
+    hamiltonian = hamiltonians.TFIM(NQUBITS, h=0.5, backend=exec_backend)
+    # two circuits with the same signature, and one with the same gate names
+    # on different qubits
+    circuits = [
+        layout_circuit([(0, 1), (1, 2)]),
+        layout_circuit([(0, 1), (1, 2)]),
+        layout_circuit([(2, 0), (1, 0)]),
+    ]
+
+    kernels = [
+        differentiation._kernel_circuit(hamiltonian, circuit, exec_backend)
+        for circuit in circuits
+    ]
+    _, first, *shared = kernels[0]
+    _, second, *cached = kernels[1]
+    # the cache hit shares the read-only layout, with a fresh copy of the matrices
+    for array, hit in zip(shared[:2], cached[:2]):
+        assert array is hit
+        assert not array.flags.writeable
+    assert first is not second
+    assert second.flags.writeable
+    assert not np.allclose(first, second)
+    assert not np.array_equal(kernels[2][2], shared[0])
+
+    gradients = [
+        parameter_shift_batch(
+            hamiltonian=hamiltonian, circuit=circuit, exec_backend=exec_backend
+        )
+        for circuit in circuits
+    ]
+    # disable the numba kernels to fall back to the backend execution
+    monkeypatch.setattr(differentiation, "KERNEL_MAX_QUBITS", 0)
+    for circuit, gradient in zip(circuits, gradients):
+        target = parameter_shift_batch(
+            hamiltonian=hamiltonian, circuit=circuit, exec_backend=exec_backend
+        )
+        np.testing.assert_allclose(gradient, target, atol=1e-10)
+
+
+@pytest.mark.parametrize("kind", ["symbols", "terms"])
+def test_kernel_hamiltonian_symbolic(monkeypatch, kind):
+    exec_backend = construct_backend("numpy")
+    if kind == "symbols":
+        form = Z(0) * Z(2) + 0.5 * X(1) * Y(0) + Z(1) * X(1) * Z(1) + 2
+        hamiltonian = hamiltonians.SymbolicHamiltonian(form, backend=exec_backend)
+    else:
+        hamiltonian = hamiltonians.TFIM(
+            NQUBITS, h=0.5, dense=False, backend=exec_backend
+        )
+    circuit = reuploading_circuit(nqubits=NQUBITS, nlayers=NLAYERS)
+    circuit.set_parameters(np.random.randn(len(circuit.get_parameters())))
+
+    gradients = parameter_shift_batch(
+        hamiltonian=hamiltonian, circuit=circuit, exec_backend=exec_backend
+    )
+    # the CSR arrays are assembled from the terms, without the dense matrix
+    assert hamiltonian._dense is None
+    data, indices, indptr = differentiation._kernel_hamiltonian(hamiltonian)
+    size = 2**NQUBITS
+    matrix = sparse.csr_matrix((data, indices, indptr), shape=(size, size))
+    np.testing.assert_allclose(matrix.toarray(), hamiltonian.matrix, atol=1e-12)
+
+    # disable the numba kernels to fall back to the backend execution
+    monkeypatch.setattr(differentiation, "KERNEL_MAX_QUBITS", 0)
+    target = parameter_shift_batch(
+        hamiltonian=hamiltonian, circuit=circuit, exec_backend=exec_backend
+    )
+    np.testing.assert_allclose(gradients, target, atol=1e-10)
+
+
+def test_adjoint_parameter_shift():
+    exec_backend = construct_backend("numpy")
+    hamiltonian = hamiltonians.Z(NQUBITS, backend=exec_backend)
+    circuit = reuploading_circuit(nqubits=NQUBITS, nlayers=NLAYERS)
+    nparams = len(circuit.get_parameters())
+    circuit.set_parameters(np.random.randn(nparams))
+
+    gradients = adjoint_parameter_shift(
+        hamiltonian=hamiltonian, circuit=circuit, exec_backend=exec_backend
+    )
+    target = [
+        parameter_shift(
+            hamiltonian=hamiltonian,
+            circuit=circuit,
+            parameter_index=p,
+            exec_backend=exec_backend,
+        )
+        for p in range(nparams)
+    ]
+    np.testing.assert_allclose(gradients, target, atol=1e-10)
+
+    with pytest.raises(ValueError):
+        adjoint_parameter_shift(
+            hamiltonian=hamiltonian,
+            circuit=circuit,
+            exec_backend=exec_backend,
+            nshots=100,
+        )
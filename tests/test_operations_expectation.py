@@ -0,0 +1,178 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+from qibo import hamiltonians
+from qibo.backends import construct_backend
+from qibo.symbols import X, Z
+
+from qiboml.models.ansatze import reuploading_circuit
+from qiboml.operations.differentiation import parameter_shift
+from qiboml.operations.expectation import _gradient, expectation
+
+NQUBITS = 3
+NLAYERS = 2
+
+
+def build_observable(kind, nqubits):
+    backend = construct_backend("numpy")
+    if kind == "dense":
+        return hamiltonians.TFIM(nqubits, h=0.5, backend=backend)
+    if kind == "diagonal":
+        return hamiltonians.Z(nqubits, backend=backend)
+    form = sum(Z(q) * Z(q + 1) for q in range(nqubits - 1)) + 0.5 * X(0) + 2
+    return hamiltonians.SymbolicHamiltonian(form, backend=backend)
+
+
+@pytest.mark.parametrize("nqubits", [NQUBITS, 8])
+@pytest.mark.parametrize("kind", ["dense", "diagonal", "symbolic"])
+def test_expectation_cache(kind, nqubits):
+    hamiltonian = build_observable(kind, nqubits)
+    circuit = reuploading_circuit(nqubits=nqubits, nlayers=NLAYERS)
+    circuit.set_parameters(np.random.randn(len(circuit.get_parameters())))
+
+    target = expectation(hamiltonian, circuit, backend="numpy", cache=False)
+    for _ in range(2):
+        value = expectation(hamiltonian, circuit, backend="numpy", cache=True)
+        np.testing.assert_allclose(value, target)
+
+
+@pytest.mark.parametrize("kind", ["dense", "diagonal", "symbolic"])
+def test_expectation_cache_update(kind):
+    hamiltonian = build_observable(kind, NQUBITS)
+    circuit = reuploading_circuit(nqubits=NQUBITS, nlayers=NLAYERS)
+    circuit.set_parameters(np.random.randn(len(circuit.get_parameters())))
+    expectation(hamiltonian, circuit, backend="numpy", cache=True)
+
+    # replacing the observable's content invalidates the prepared copy
+    if kind == "symbolic":
+        hamiltonian.constant += 1
+    else:
+        hamiltonian.matrix = -2 * hamiltonian.matrix
+    value = expectation(hamiltonian, circuit, backend="numpy", cache=True)
+    target = expectation(hamiltonian, circuit, backend="numpy", cache=False)
+    np.testing.assert_allclose(value, target)
+
+
+@pytest.mark.parametrize("cache", [False, True])
+@pytest.mark.parametrize("kind", ["dense", "diagonal", "symbolic"])
+def test_expectation_precision(kind, cache):
+    hamiltonian = build_observable(kind, NQUBITS)
+    circuit = reuploading_circuit(nqubits=NQUBITS, nlayers=NLAYERS)
+    circuit.set_parameters(np.random.randn(len(circuit.get_parameters())))
+
+    target = expectation(hamiltonian, circuit, backend="numpy", cache=cache)
+    value = expectation(
+        hamiltonian, circuit, backend="numpy", cache=cache, precision="single"
+    )
+    np.testing.assert_allclose(value, target, atol=1e-5)
+
+    with pytest.raises(ValueError):
+        expectation(hamiltonian, circuit, backend="numpy", precision="half")
+
+
+def tf_gradient(circuit, parameters, **kwargs):
+    tf = pytest.importorskip("tensorflow")
+    from qiboml.backends import TensorflowBackend
+
+    hamiltonian = hamiltonians.TFIM(NQUBITS, h=0.5, backend=TensorflowBackend())
+    variable = tf.Variable(parameters)
+    with tf.GradientTape() as tape:
+        circuit.set_parameters(variable)
+        value = expectation(hamiltonian, circuit, backend="numpy", **kwargs)
+    return tape.gradient(value, variable).numpy()
+
+
+def non_batched_rule(**kwargs):
+    # not batched, thus evaluated one parameter at a time
+    return parameter_shift(**kwargs)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"differentiation_rule": parameter_shift, "cache": None},
+        {"differentiation_rule": parameter_shift, "cache": False},
+        {"differentiation_rule": non_batched_rule, "parallel": True},
+    ],
+)
+def test_expectation_tf_gradient(kwargs):
+    circuit = reuploading_circuit(nqubits=NQUBITS, nlayers=NLAYERS)
+    parameters = np.random.randn(len(circuit.get_parameters()))
+    gradients = tf_gradient(circuit, parameters, **kwargs)
+
+    backend = construct_backend("numpy")
+    hamiltonian = hamiltonians.TFIM(NQUBITS, h=0.5, backend=backend)
+    circuit.set_parameters(parameters)
+    target = [
+        parameter_shift(hamiltonian, circuit, p, backend)
+        for p in range(len(parameters))
+    ]
+    np.testing.assert_allclose(gradients, target, atol=1e-10)
+
+
+def test_gradient_parallel():
+    hamiltonian = build_observable("dense", NQUBITS)
+    circuit = reuploading_circuit(nqubits=NQUBITS, nlayers=NLAYERS)
+    circuit.set_parameters(np.random.randn(len(circuit.get_parameters())))
+    parameters = circuit.get_parameters()
+    backend = construct_backend("numpy")
+
+    gradients = [
+        _gradient(
+            hamiltonian,
+            circuit,
+            None,
+            None,
+            backend,
+            non_batched_rule,
+            len(parameters),
+            parallel,
+        )
+        for parallel in (False, True)
+    ]
+    np.testing.assert_allclose(gradients[1], gradients[0])
+    assert circuit.get_parameters() == parameters
+
+
+PARALLEL_FIRST = """
+import os
+
+import numpy as np
+from qibo import hamiltonians
+from qibo.backends import construct_backend
+
+from qiboml.models.ansatze import reuploading_circuit
+from qiboml.operations.differentiation import parameter_shift
+from qiboml.operations.expectation import _gradient
+
+backend = construct_backend("numpy")
+hamiltonian = hamiltonians.TFIM(3, h=0.5, backend=backend)
+circuit = reuploading_circuit(nqubits=3, nlayers=2)
+nparams = len(circuit.get_parameters())
+circuit.set_parameters(np.random.randn(nparams))
+
+
+def rule(**kwargs):
+    return parameter_shift(**kwargs)
+
+
+# several workers even on machines with a single core
+os.cpu_count = lambda: 4
+_gradient(hamiltonian, circuit, None, None, backend, rule, nparams, True)
+"""
+
+
+def test_gradient_parallel_first():
+    # the first kernel calls of the process happen on the worker threads,
+    # with numba's threading layer which is not threadsafe
+    env = dict(os.environ, NUMBA_THREADING_LAYER="workqueue")
+    result = subprocess.run(
+        [sys.executable, "-c", PARALLEL_FIRST],
+        env=env,
+        capture_output=True,
+        timeout=300,
+    )
+    assert result.returncode == 0, result.stderr.decode()